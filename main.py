@@ -1,17 +1,135 @@
+import ahocorasick
 import anthropic
+from anthropic.types.message_create_params import MessageCreateParamsNonStreaming
+from anthropic.types.messages.batch_create_params import Request
+import asyncio
+import atexit
+from datetime import datetime, timezone
+import httpx
 import json
-from typing import Dict, List, Tuple
+import orjson
+from typing import Dict, Iterator, Tuple
 import time
 import logging
+import numpy as np
+from numba import njit
 import toml
 from pathlib import Path
-from myutils import read_csv
+from myutils import read_csv_columns
 import os
+import queue
+import threading
+
+
+# 모든 요청에서 동일하므로 프롬프트 캐시 대상으로 지정한다
+_SYSTEM_PROMPT = 'You are a Chinese to Korean translator specializing in wuxia game localization. Follow these guidelines for translation:\n\n1. Markup and placeholder handling:\n- Keep {placeholder} unchanged and add appropriate Korean particles\n  e.g.) "{player_name}获得了{item_count}个{item_name}" \n        → "{player_name}이(가) {item_name}을(를) {item_count}개 획득했습니다"\n- Preserve <tag></tag> structure and only translate the text inside\n  e.g.) "<color>获得{item_count}个{item_name}</color>" \n        → "<color>{item_name}을(를) {item_count}개 획득했습니다</color>"\n\n2. Translation principles:\n- Consider meaning and rhythm when translating faction names, character names, and martial arts skills\n- Translate UI concisely and story text with appropriate style\n- Follow Korean wuxia conventions for genre terms (기공, 내공, etc.)\n- Keep commonly used Chinese idioms in Korean hanja form, localize unfamiliar ones\n- Choose contextually appropriate translations for single-character words\n  e.g.) "魂" can be "혼" or "넋" depending on context\n  e.g.) "气" can be "기" or "공기" depending on context\n\n3. Terms extraction:\n- Add source text and translated terms to new_terms:\n  * Complete item and skill names\n  * Full character/faction names \n  * System features and mechanics\n  * Recurring multi-character game terms\n  * Special effects and states\n- Do NOT add:\n  * Single characters that form parts of longer terms\n  * Generic single-character words with multiple contextual meanings\n\n4. Input/Output format:\nInput: {\n    "terms_dictionary": {"chinese": "korean"},     // optional, existing translations\n    "texts": {"id": "source text"}                // required\n}\n\nOutput: {\n    "result": {"id": "translated text with escaped quotes"},  \n    "comment": "review notes",                    // optional, only include if review or clarification needed\n    "new_terms": {"chinese": "korean"}            // only add complete terms, not components\n}\n\nNote: Always escape quotes in text content with backslash: \\"example\\"'
+
+
+@njit(cache=True)
+def _split_offsets(lengths: np.ndarray, target: float) -> np.ndarray:
+    """길이 배열을 앞에서부터 target 이하로 묶었을 때 각 청크의 끝 위치 (target보다 긴 텍스트도 최소 하나는 담는다)"""
+    offsets = np.empty(len(lengths), dtype=np.int64)
+    count = 0
+    chunk_start = 0
+    total = 0
+    for i in range(len(lengths)):
+        if total + lengths[i] > target and i > chunk_start:
+            offsets[count] = i
+            count += 1
+            chunk_start = i
+            total = 0
+        total += lengths[i]
+    if len(lengths):
+        offsets[count] = len(lengths)
+        count += 1
+    return offsets[:count]
+
+
+class RateLimiter:
+    """분당 요청 수/토큰 수 기준 토큰 버킷 (용량은 경과 시간에 비례해 보충)"""
+
+    def __init__(self, max_requests_per_minute: float, max_tokens_per_minute: float):
+        self.max_requests_per_minute = max_requests_per_minute
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.available_request_capacity = max_requests_per_minute
+        self.available_token_capacity = max_tokens_per_minute
+        self.last_update_time = time.monotonic()
+        self.next_allowed_time = 0.0  # 서버가 알려준 한도 초기화 시각까지는 전송하지 않는다
+        self._lock = asyncio.Lock()
+
+    def _replenish(self):
+        now = time.monotonic()
+        elapsed = now - self.last_update_time
+        self.available_request_capacity = min(
+            self.available_request_capacity + self.max_requests_per_minute * elapsed / 60,
+            self.max_requests_per_minute,
+        )
+        self.available_token_capacity = min(
+            self.available_token_capacity + self.max_tokens_per_minute * elapsed / 60,
+            self.max_tokens_per_minute,
+        )
+        self.last_update_time = now
+
+    async def acquire(self, token_cost: int):
+        """요청 1건과 token_cost만큼의 용량이 생길 때까지 대기한 뒤 차감"""
+        # 한 요청이 버킷 전체보다 크면 영원히 대기하게 되므로 상한을 둔다
+        token_cost = min(token_cost, self.max_tokens_per_minute)
+        async with self._lock:
+            while True:
+                wait = self.next_allowed_time - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    continue
+
+                self._replenish()
+                if self.available_request_capacity >= 1 and self.available_token_capacity >= token_cost:
+                    self.available_request_capacity -= 1
+                    self.available_token_capacity -= token_cost
+                    return
+                await asyncio.sleep(1)
+
+    def pause(self, seconds: float):
+        """지금부터 seconds 동안 모든 워커의 전송을 멈춘다"""
+        self.next_allowed_time = max(self.next_allowed_time, time.monotonic() + seconds)
+
+    def update_from_headers(self, headers: httpx.Headers):
+        """응답의 anthropic-ratelimit-* 헤더로 남은 용량을 맞추고, 소진된 한도는 초기화 시각까지 대기"""
+        for kind in ("requests", "tokens", "input-tokens"):
+            remaining = headers.get(f"anthropic-ratelimit-{kind}-remaining")
+            if remaining is None:
+                continue
+            reset = headers.get(f"anthropic-ratelimit-{kind}-reset")
+
+            # 헤더 형식이 이상해도 이미 받은 응답을 버리지 않도록 해당 헤더만 건너뛴다
+            try:
+                remaining = int(remaining)
+                # Python 3.11 미만의 fromisoformat은 "Z" 접미사를 읽지 못한다
+                reset_time = datetime.fromisoformat(reset.replace("Z", "+00:00")) if reset else None
+            except ValueError as e:
+                logging.getLogger(__name__).warning(f"Ignoring malformed anthropic-ratelimit-{kind} header: {e}")
+                continue
+
+            # 서버가 남았다고 알려준 양보다 많이 보내지 않는다
+            if kind == "requests":
+                self.available_request_capacity = min(self.available_request_capacity, remaining)
+            else:
+                self.available_token_capacity = min(self.available_token_capacity, remaining)
+
+            if remaining == 0 and reset_time:
+                until_reset = reset_time - datetime.now(timezone.utc)
+                self.pause(until_reset.total_seconds())
 
 
 class GameTranslator:
     def __init__(self, api_key: str, model: str = "claude-3-5-sonnet-20241022", save_dir: str = "translation_data"):
-        self.client = anthropic.Anthropic(api_key=api_key)
+        # 워커들이 HTTP/2 연결을 공유해 요청마다 TCP/TLS 연결을 새로 맺지 않도록 한다
+        http_client = anthropic.DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            timeout=httpx.Timeout(600.0, connect=5.0),
+        )
+        # 재시도는 워커의 재시도 루프와 RateLimiter(retry-after 포함)만 담당하도록 SDK 자체 재시도는 끈다
+        self.client = anthropic.AsyncAnthropic(api_key=api_key, http_client=http_client, max_retries=0)
         self.model = model
         self.save_dir = Path(save_dir)
         self.save_dir.mkdir(exist_ok=True)
@@ -22,6 +140,34 @@ class GameTranslator:
         # 저장된 데이터 복구
         self.glossary = self.load_json("glossary.json", {})
         self.translated = self.load_json("translations.json", {})
+
+        # 청크마다 전체 파일을 다시 쓰지 않도록 변경분은 jsonl에 덧붙이고,
+        # 일정 청크마다(그리고 종료 시) 전체 스냅샷을 저장한 뒤 jsonl을 비운다 (종료 시에만 들여쓰기)
+        self.replay_journal("glossary.jsonl", self.glossary)
+        self.replay_journal("translations.jsonl", self.translated)
+        self._journals = {name: open(self.save_dir / name, "ab") for name in ("glossary.jsonl", "translations.jsonl")}
+        self.snapshot_interval = 100
+        self._chunks_since_snapshot = 0
+
+        # 파일 쓰기는 백그라운드 스레드가 맡아 API 호출과 겹치게 한다
+        self._write_queue = queue.Queue()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+        # 원문이 같은 id들 중 대표 id -> 나머지 id들 (대표 id의 번역을 그대로 복사)
+        self._shared_ids = {}
+
+        # glossary가 바뀔 때마다 버전을 올리고, 용어 오토마톤은 버전이 다를 때만 다시 만든다
+        self._glossary_version = 0
+        self._ac_version = None
+        self._ac = None
+
+        # 용어의 모든 부분 문자열 -> 그 부분 문자열을 포함하는 용어들, 용어 -> 그 용어를 포함하는 더 긴 용어들
+        # 새 용어가 들어올 때마다 그 용어만 추가로 색인한다
+        self._substring_owners = {}
+        self._superterms = {}
+        self.index_terms(self.glossary)
         self.target_length = 1000  # 초기 목표 텍스트 길이
 
     def setup_logging(self):
@@ -37,207 +183,490 @@ class GameTranslator:
         file_path = self.save_dir / filename
         if file_path.exists():
             try:
-                with open(file_path, "r", encoding="utf-8") as f:
-                    return json.load(f)
-            except json.JSONDecodeError as e:
+                return orjson.loads(file_path.read_bytes())
+            except orjson.JSONDecodeError as e:
                 self.logger.error(f"Error loading {filename}: {e}")
                 return default_value
         return default_value
 
-    def save_json(self, data: dict, filename: str):
+    def _term_automaton(self) -> ahocorasick.Automaton:
+        """glossary 용어 검색용 Aho–Corasick 오토마톤 (glossary 버전이 바뀐 경우에만 재생성)"""
+        if self._ac_version != self._glossary_version:
+            self._ac = ahocorasick.Automaton()
+            for term in self.glossary:
+                if term:
+                    self._ac.add_word(term, term)
+            self._ac.make_automaton()
+            self._ac_version = self._glossary_version
+        return self._ac
+
+    def index_terms(self, terms: Dict[str, str]):
+        """새 용어의 부분 문자열을 색인하고, 서로 포함 관계인 용어들의 상위 용어 목록을 갱신"""
+        for term in terms:
+            if not term or term in self._substring_owners.get(term, ()):
+                continue  # 이미 색인된 용어 (번역만 바뀐 경우)
+
+            # 이미 있는 더 긴 용어 중 이 용어를 포함하는 것들
+            owners = self._substring_owners.get(term)
+            if owners:
+                self._superterms.setdefault(term, set()).update(owners)
+
+            # 이 용어 안에 들어 있는 glossary 용어들의 상위 용어로 등록
+            for start in range(len(term)):
+                for end in range(start + 1, len(term) + 1):
+                    substring = term[start:end]
+                    self._substring_owners.setdefault(substring, set()).add(term)
+                    if substring != term and substring in self.glossary:
+                        self._superterms.setdefault(substring, set()).add(term)
+
+    def save_json(self, data: dict, filename: str, option: int = 0) -> bool:
+        """프로그램이 다시 읽는 파일이므로 기본은 들여쓰기 없이 저장"""
         file_path = self.save_dir / filename
         # 임시 파일에 먼저 저장
         temp_path = file_path.with_suffix(".tmp")
         try:
-            with open(temp_path, "w", encoding="utf-8") as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            payload = memoryview(orjson.dumps(data, option=option | orjson.OPT_NON_STR_KEYS))
+            fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                while payload:
+                    payload = payload[os.write(fd, payload) :]
+                # 교체 전에 디스크에 기록되었는지 확인
+                os.fsync(fd)
+            finally:
+                os.close(fd)
             # 성공적으로 저장되면 원본 파일 교체
-            temp_path.replace(file_path)
+            os.replace(temp_path, file_path)
+            return True
         except Exception as e:
             self.logger.error(f"Error saving {filename}: {e}")
             if temp_path.exists():
                 temp_path.unlink()
+            return False
 
-    def create_chunk(self, texts: Dict[str, str]) -> List[Tuple[str, Dict[str, str]]]:
-        chunks = []
-        current_chunk = {}
-        current_length = 0
+    def save_json_pretty(self, data: dict, filename: str) -> bool:
+        """사람이 읽을 파일용 (들여쓰기 2칸)"""
+        return self.save_json(data, filename, orjson.OPT_INDENT_2)
 
-        for id_, text in texts.items():
-            if id_ in self.translated:
-                continue
+    def replay_journal(self, filename: str, data: dict):
+        """마지막 스냅샷 이후 jsonl에 기록된 변경분을 data에 반영"""
+        file_path = self.save_dir / filename
+        if not file_path.exists():
+            return
+        with open(file_path, "rb") as f:
+            for line in f:
+                try:
+                    data.update(orjson.loads(line))
+                except orjson.JSONDecodeError:
+                    # 기록 도중 종료되어 잘린 마지막 줄
+                    self.logger.warning(f"Skipping broken line in {filename}")
+
+    def append_journal(self, filename: str, entries: dict):
+        """변경분을 한 줄에 한 항목씩 jsonl에 덧붙이도록 쓰기 스레드에 넘김"""
+        payload = b"".join(orjson.dumps({key: value}) + b"\n" for key, value in entries.items())
+        self._write_queue.put(("append", filename, payload))
+
+    def save_snapshot(self, pretty: bool = False):
+        """현재 translations/glossary의 복사본을 쓰기 스레드에 넘김 (저장에 성공하면 해당 jsonl은 비운다)"""
+        option = orjson.OPT_INDENT_2 if pretty else 0
+        self._write_queue.put(("snapshot", "translations.json", "translations.jsonl", dict(self.translated), option))
+        self._write_queue.put(("snapshot", "glossary.json", "glossary.jsonl", dict(self.glossary), option))
+        self._chunks_since_snapshot = 0
+
+    def _write_loop(self):
+        """쓰기 큐에 쌓인 작업을 한꺼번에 꺼내 처리 (None을 받으면 종료)"""
+        while True:
+            items = [self._write_queue.get()]
+            while True:
+                try:
+                    items.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
 
-            text_length = len(text)
+            try:
+                self._write_items(items)
+            except Exception as e:
+                self.logger.error(f"Error in background writer: {e}")
+            finally:
+                for _ in items:
+                    self._write_queue.task_done()
+
+            if None in items:
+                return
 
-            # 현재 청크가 목표 길이를 초과하면 새로운 청크 시작
-            if current_length + text_length > self.target_length and current_chunk:
-                chunks.append(self.prepare_request(current_chunk))
-                current_chunk = {}
-                current_length = 0
+    def _write_items(self, items: list):
+        """같은 파일의 스냅샷은 마지막 것만 저장하고, jsonl 추가분은 파일별로 모아서 한 번에 기록"""
+        last_snapshot = {item[1]: i for i, item in enumerate(items) if item is not None and item[0] == "snapshot"}
+        appends = {}
 
-            current_chunk[id_] = text
-            current_length += text_length
+        def write_appends(journal: str):
+            payloads = appends.pop(journal, None)
+            if payloads:
+                f = self._journals[journal]
+                f.write(b"".join(payloads))
+                f.flush()
 
-        if current_chunk:
-            chunks.append(self.prepare_request(current_chunk))
+        for i, item in enumerate(items):
+            if item is None:
+                continue
+            if item[0] == "append":
+                _, journal, payload = item
+                appends.setdefault(journal, []).append(payload)
+                continue
 
-        return chunks
+            _, filename, journal, data, option = item
+            if last_snapshot[filename] != i:
+                continue  # 뒤에 더 최신 스냅샷이 있다
+            # 스냅샷보다 먼저 들어온 변경분을 기록한 뒤 스냅샷이 성공하면 비운다
+            write_appends(journal)
+            if self.save_json(data, filename, option):
+                self._journals[journal].truncate(0)
+
+        for journal in list(appends):
+            write_appends(journal)
+
+    def flush_writes(self):
+        """지금까지 넘긴 쓰기 작업이 모두 끝날 때까지 대기"""
+        self._write_queue.join()
+
+    def close(self):
+        """보기 좋게 정리한 최종 스냅샷을 저장하고 쓰기 스레드를 종료"""
+        if not self._writer.is_alive():
+            return
+        self.save_snapshot(pretty=True)
+        self._write_queue.put(None)
+        self._writer.join()
 
     def prepare_request(self, texts: Dict[str, str]) -> Tuple[str, Dict[str, str]]:
-        # 용어를 길이순으로 정렬하여 중복 체크
-        def is_subprocess(short_term: str, term_list: list) -> bool:
-            """주어진 용어가 다른 긴 용어의 부분인지 확인"""
-            for long_term in term_list:
-                if short_term != long_term and short_term in long_term:
-                    return True
-            return False
-
-        # 현재 glossary의 용어들을 길이 순으로 정렬
-        sorted_terms = sorted(self.glossary.keys(), key=len, reverse=True)
-
-        # 더 긴 용어의 부분이 아닌 용어만 선택
-        relevant_terms = {}
-        for term in sorted_terms:
-            # 현재 텍스트들 중 하나라도 이 용어를 포함하고 있는지 확인
-            if any(term in text for text in texts.values()):
-                # 이미 선택된 더 긴 용어의 부분이 아닌 경우에만 추가
-                if not is_subprocess(term, [t for t in relevant_terms.keys()]):
-                    relevant_terms[term] = self.glossary[term]
+        # 청크 전체를 한 번만 훑어서 등장하는 glossary 용어 수집
+        blob = "\n".join(texts.values())
+        automaton = self._term_automaton()
+        matched_terms = {term for _, term in automaton.iter(blob)} if len(automaton) else set()
+
+        # 함께 등장한 더 긴 용어의 부분인 용어는 제외
+        relevant_terms = {
+            term: self.glossary[term]
+            for term in sorted(matched_terms, key=len, reverse=True)
+            if self._superterms.get(term, set()).isdisjoint(matched_terms)
+        }
 
         request_data = {"terms_dictionary": relevant_terms, "texts": texts}
 
         # 요청 데이터 로깅
         self.logger.info(f"Preparing request with terms dictionary size: {len(relevant_terms)}")
-        self.logger.info(f"Full request data: {json.dumps(request_data, ensure_ascii=False)}")
+        request_json = orjson.dumps(request_data).decode()
+        self.logger.debug("Full request data: %s", request_json)
 
-        return json.dumps(request_data, ensure_ascii=False), texts
+        return request_json, texts
 
-    def process_response(self, response: list | str, original_texts: Dict[str, str]):
+    def process_response(self, response: list | str, original_texts: Dict[str, str]) -> set:
+        """응답을 반영하고 번역이 저장된 id들을 반환 (응답이 비었거나 잘려서 파싱에 실패하면 빈 집합)"""
+        stored = set()
         try:
             if isinstance(response, list):
                 response_text = response[0].text if response else ""
             else:
                 response_text = response
 
-            self.logger.info(f"Full response received: {response_text}")
+            self.logger.debug("Full response received: %s", response_text)
 
             if not response_text:
                 self.logger.error("Empty response received")
-                return
+                return stored
 
-            result = json.loads(response_text)
+            result = orjson.loads(response_text)
 
             if "result" in result:
-                self.translated.update(result["result"])
-                self.save_json(self.translated, "translations.json")
-                self.logger.info(f"Translated {len(result['result'])} texts")
+                translated = dict(result["result"])
+                for id_, text in result["result"].items():
+                    for other_id in self._shared_ids.get(id_, ()):
+                        translated[other_id] = text
+                self.translated.update(translated)
+                self.append_journal("translations.jsonl", translated)
+                stored.update(translated)
+                self.logger.info(f"Translated {len(result['result'])} texts ({len(translated)} ids)")
 
             if "new_terms" in result:
                 new_terms = len(result["new_terms"])
                 if new_terms > 0:
                     self.glossary.update(result["new_terms"])
-                    self.save_json(self.glossary, "glossary.json")
+                    self._glossary_version += 1
+                    self.index_terms(result["new_terms"])
+                    self.append_journal("glossary.jsonl", result["new_terms"])
                     self.logger.info(f"Added new terms to glossary: {result['new_terms']}")
 
             if "comment" in result:
                 self.logger.info(f"Translation comment: {result['comment']}")
 
-        except json.JSONDecodeError as e:
+            self._chunks_since_snapshot += 1
+            if self._chunks_since_snapshot >= self.snapshot_interval:
+                self.save_snapshot()
+
+        except (json.JSONDecodeError, orjson.JSONDecodeError) as e:
             self.logger.error(f"Error processing response: {e}")
             self.logger.error(f"Raw response: {response_text}")
         except Exception as e:
             self.logger.error(f"Unexpected error processing response: {e}")
             self.logger.error(f"Raw response: {response}")
 
-    def adjust_chunk_size(self, success: bool):
-        """응답 성공/실패에 따라 청크 크기 조정"""
-        if success:
-            self.target_length = min(self.target_length * 1.2, 2400)
-        else:
-            self.target_length = max(self.target_length * 0.8, 1200)
-        self.logger.info(f"Adjusted target length to: {self.target_length}")
+        return stored
+
+    def record_failed(self, texts: Dict[str, str]):
+        """번역에 실패한 텍스트를 failed_translations.json에 추가 (여러 워커가 실패해도 덮어쓰지 않는다)"""
+        failed = self.load_json("failed_translations.json", {})
+        failed.update(texts)
+        # 대표 id만 요청했으므로 같은 원문을 공유하던 id들도 함께 실패로 남긴다
+        for id_, text in texts.items():
+            for other_id in self._shared_ids.get(id_, ()):
+                failed[other_id] = text
+        self.save_json_pretty(failed, "failed_translations.json")
 
-    def create_next_chunk(self, texts: Dict[str, str], current_length: int = 0) -> Tuple[str, Dict[str, str]]:
-        """다음 청크 생성"""
-        current_chunk = {}
-        total_length = 0
+    def deduplicate_sources(self, texts: Dict[str, str]) -> Dict[str, str]:
+        """원문이 같은 id들은 대표 id 하나만 번역하도록 묶는다
 
+        번역할 {대표 id: 원문}을 반환하고, 나머지 id들은 self._shared_ids에 기록해 두었다가
+        대표 id의 번역을 복사한다. 이미 번역된 id가 있는 원문은 그 번역을 바로 채운다.
+        """
+        by_source = {}
         for id_, text in texts.items():
-            if id_ in self.translated:
+            by_source.setdefault(text, []).append(id_)
+
+        unique_texts = {}
+        reused = {}
+        self._shared_ids = {}
+        for text, ids in by_source.items():
+            done_id = next((id_ for id_ in ids if id_ in self.translated), None)
+            if done_id is not None:
+                for id_ in ids:
+                    if id_ not in self.translated:
+                        reused[id_] = self.translated[done_id]
                 continue
 
-            text_length = len(text)
-            if total_length + text_length > self.target_length:
-                break
+            unique_texts[ids[0]] = text
+            if len(ids) > 1:
+                self._shared_ids[ids[0]] = ids[1:]
 
-            current_chunk[id_] = text
-            total_length += text_length
+        if reused:
+            self.translated.update(reused)
+            self.append_journal("translations.jsonl", reused)
 
-        if current_chunk:
-            return self.prepare_request(current_chunk)
-        return None, None
+        self.logger.info(
+            f"Deduplicated sources: {len(unique_texts)} unique texts to translate, "
+            f"{sum(map(len, self._shared_ids.values()))} sharing ids, {len(reused)} filled from existing translations"
+        )
+        return unique_texts
 
-    def translate_all(self, texts: Dict[str, str]):
-        total_texts = len(texts)
-        processed_count = len(self.translated)
-        remaining_texts = {k: v for k, v in texts.items() if k not in self.translated}
+    def adjust_chunk_size(self, success: bool):
+        """응답 성공/실패에 따라 청크 크기 조정"""
+        if success:
+            self.target_length = min(self.target_length * 1.2, 2400)
+        else:
+            self.target_length = max(self.target_length * 0.8, 1200)
+        self.logger.info(f"Adjusted target length to: {self.target_length}")
 
-        self.logger.info(f"Starting translation: {total_texts} total texts, " f"{processed_count} already translated")
+    def _iter_chunks(
+        self, pending: Dict[str, str], target_length: float | None = None
+    ) -> Iterator[Dict[str, str]]:
+        """pending을 앞에서부터 차례로 청크({id: 원문})로 나눠 생성 (요청 데이터는 호출하는 쪽에서 만든다)
+
+        target_length를 주면 그 길이로 고정하고, 없으면 self.target_length를 따르며
+        조정된 크기는 남은 텍스트를 다시 나눠 다음 청크부터 반영한다.
+        """
+        ids = list(pending)
+        lengths = np.fromiter((len(pending[id_]) for id_ in ids), dtype=np.int64, count=len(ids))
+        start = 0
+
+        while start < len(ids):
+            target = target_length or self.target_length
+            for end in _split_offsets(lengths[start:], float(target)) + start:
+                yield {id_: pending[id_] for id_ in ids[start:end]}
+                start = int(end)
+                if (target_length or self.target_length) != target:
+                    break
 
-        while remaining_texts:
-            request_data, original_chunk = self.create_next_chunk(remaining_texts)
-            if not request_data:
-                break
+    def _message_params(self, request_data: str) -> dict:
+        """messages.create 및 배치 요청에 공통으로 쓰는 파라미터"""
+        return {
+            "model": self.model,
+            "max_tokens": 8192,
+            "temperature": 0,
+            "system": [{"type": "text", "text": _SYSTEM_PROMPT, "cache_control": {"type": "ephemeral"}}],
+            "messages": [{"role": "user", "content": [{"type": "text", "text": request_data}]}],
+        }
+
+    async def _produce_chunks(self, texts: Dict[str, str], chunk_queue: asyncio.Queue, num_workers: int):
+        """남은 텍스트를 청크로 나눠 큐에 넣고, 끝나면 워커 수만큼 종료 신호(None)를 넣는다"""
+        # 번역할 텍스트는 처음 한 번만 골라낸다
+        pending = {k: v for k, v in texts.items() if k not in self.translated}
+
+        # 큐에는 청크의 텍스트만 넣고 요청 데이터는 워커가 꺼낸 직후 최신 glossary로 만든다.
+        # 청크 경계는 큐에 들어갈 때 정해지므로, 조정된 target_length는 이미 큐에 있는 청크 이후부터 반영된다.
+        for original_chunk in self._iter_chunks(pending):
+            await chunk_queue.put(original_chunk)
+
+        for _ in range(num_workers):
+            await chunk_queue.put(None)
+
+    async def _worker(self, chunk_queue: asyncio.Queue, limiter: RateLimiter, lock: asyncio.Lock, total_texts: int):
+        while True:
+            item = await chunk_queue.get()
+            if item is None:
+                return
 
+            original_chunk = item
+            request_data, _ = self.prepare_request(original_chunk)
             retry_count = 0
             max_retries = 3
+            # 429, 서버 과부하(5xx), 연결 오류는 청크 문제가 아니므로 따로 세고 청크 크기도 줄이지 않는다
+            transient_count = 0
+            max_transient_retries = 10
 
-            while retry_count < max_retries:
+            while retry_count < max_retries and transient_count < max_transient_retries:
                 try:
                     self.logger.info(f"Processing chunk size: {len(original_chunk)}")
 
-                    message = self.client.messages.create(
-                        model=self.model,
-                        max_tokens=8192,
-                        temperature=0,
-                        system='You are a Chinese to Korean translator specializing in wuxia game localization. Follow these guidelines for translation:\n\n1. Markup and placeholder handling:\n- Keep {placeholder} unchanged and add appropriate Korean particles\n  e.g.) "{player_name}获得了{item_count}个{item_name}" \n        → "{player_name}이(가) {item_name}을(를) {item_count}개 획득했습니다"\n- Preserve <tag></tag> structure and only translate the text inside\n  e.g.) "<color>获得{item_count}个{item_name}</color>" \n        → "<color>{item_name}을(를) {item_count}개 획득했습니다</color>"\n\n2. Translation principles:\n- Consider meaning and rhythm when translating faction names, character names, and martial arts skills\n- Translate UI concisely and story text with appropriate style\n- Follow Korean wuxia conventions for genre terms (기공, 내공, etc.)\n- Keep commonly used Chinese idioms in Korean hanja form, localize unfamiliar ones\n- Choose contextually appropriate translations for single-character words\n  e.g.) "魂" can be "혼" or "넋" depending on context\n  e.g.) "气" can be "기" or "공기" depending on context\n\n3. Terms extraction:\n- Add source text and translated terms to new_terms:\n  * Complete item and skill names\n  * Full character/faction names \n  * System features and mechanics\n  * Recurring multi-character game terms\n  * Special effects and states\n- Do NOT add:\n  * Single characters that form parts of longer terms\n  * Generic single-character words with multiple contextual meanings\n\n4. Input/Output format:\nInput: {\n    "terms_dictionary": {"chinese": "korean"},     // optional, existing translations\n    "texts": {"id": "source text"}                // required\n}\n\nOutput: {\n    "result": {"id": "translated text with escaped quotes"},  \n    "comment": "review notes",                    // optional, only include if review or clarification needed\n    "new_terms": {"chinese": "korean"}            // only add complete terms, not components\n}\n\nNote: Always escape quotes in text content with backslash: \\"example\\"',
-                        messages=[{"role": "user", "content": [{"type": "text", "text": request_data}]}],
+                    # 입력 토큰 수는 요청 길이로 대략 추정 (한자 1자 ≈ 1토큰)
+                    await limiter.acquire(len(request_data))
+                    raw_response = await self.client.messages.with_raw_response.create(**self._message_params(request_data))
+                    limiter.update_from_headers(raw_response.headers)
+                    # Message 모델을 만들지 않고 응답 본문(bytes)에서 바로 텍스트를 꺼낸다
+                    content = orjson.loads(raw_response.content)["content"]
+                    response_text = content[0]["text"] if content else ""
+
+                    async with lock:
+                        stored = self.process_response(response_text, original_chunk)
+                        # 응답이 잘렸거나 일부 id가 빠졌으면 실패로 보고 빠진 텍스트만 다시 요청한다
+                        missing = {id_: text for id_, text in original_chunk.items() if id_ not in stored}
+                        self.adjust_chunk_size(not missing)
+
+                        processed_count = len(self.translated)
+                        progress = (processed_count / total_texts) * 100
+                        self.logger.info(f"Progress: {progress:.2f}% ({processed_count}/{total_texts})")
+                        self.logger.info(f"Current glossary size: {len(self.glossary)}")
+
+                    if not missing:
+                        break
+
+                    retry_count += 1
+                    self.logger.error(
+                        f"{len(missing)}/{len(original_chunk)} texts missing from response "
+                        f"(attempt {retry_count}/{max_retries})"
                     )
+                    original_chunk = missing
+                    request_data, _ = self.prepare_request(original_chunk)
 
-                    # 응답 처리 전 전체 응답 로깅
-                    if isinstance(message.content, list):
-                        response_text = message.content[0].text if message.content else ""
+                except Exception as e:
+                    if isinstance(e, anthropic.RateLimitError):
+                        transient_count += 1
+                        try:
+                            delay = float(e.response.headers["retry-after"])
+                        except (KeyError, ValueError):
+                            delay = min(2**transient_count, 60)
+                        self.logger.warning(
+                            f"Rate limited, pausing {delay:.1f}s (attempt {transient_count}/{max_transient_retries})"
+                        )
+                        # 서버가 알려준 시간만큼 모든 워커를 멈춘다 (재시도 전 acquire에서 대기)
+                        limiter.pause(delay)
+                    elif isinstance(e, anthropic.APIConnectionError) or (
+                        isinstance(e, anthropic.APIStatusError) and e.status_code >= 500
+                    ):
+                        transient_count += 1
+                        delay = min(2**transient_count, 60)
+                        self.logger.warning(
+                            f"Transient API error, retrying in {delay}s "
+                            f"(attempt {transient_count}/{max_transient_retries}): {e}"
+                        )
+                        await asyncio.sleep(delay)
                     else:
-                        response_text = message.content
-                    self.logger.info(f"Raw API response: {response_text}")
+                        retry_count += 1
+                        self.logger.error(f"Error processing chunk (attempt {retry_count}/{max_retries}): {e}")
+                        async with lock:
+                            self.adjust_chunk_size(False)
+                        if retry_count < max_retries:
+                            await asyncio.sleep(retry_count * 2)
+            else:
+                self.logger.error(
+                    f"Failed to process chunk after {retry_count} errors and {transient_count} transient failures"
+                )
+                # 실패한 청크의 텍스트들을 기록
+                async with lock:
+                    self.record_failed(original_chunk)
+
+    async def translate_all(
+        self,
+        texts: Dict[str, str],
+        num_workers: int = 8,
+        max_requests_per_minute: float = 40,
+        max_tokens_per_minute: float = 16_000,
+    ):
+        total_texts = len(texts)
+        processed_count = len(self.translated)
 
-                    self.process_response(message.content, original_chunk)
-                    self.adjust_chunk_size(True)
+        self.logger.info(
+            f"Starting translation: {total_texts} total texts, "
+            f"{processed_count} already translated, {num_workers} workers"
+        )
 
-                    # 번역된 텍스트 제거
-                    remaining_texts = {k: v for k, v in texts.items() if k not in self.translated}
+        chunk_queue = asyncio.Queue(maxsize=num_workers)
+        limiter = RateLimiter(max_requests_per_minute, max_tokens_per_minute)
+        lock = asyncio.Lock()  # self.translated / self.glossary 갱신 보호
 
-                    processed_count = len(self.translated)
-                    progress = (processed_count / total_texts) * 100
-                    self.logger.info(f"Progress: {progress:.2f}% ({processed_count}/{total_texts})")
-                    self.logger.info(f"Current glossary size: {len(self.glossary)}")
+        workers = [self._worker(chunk_queue, limiter, lock, total_texts) for _ in range(num_workers)]
+        unique_texts = self.deduplicate_sources(texts)
+        await asyncio.gather(self._produce_chunks(unique_texts, chunk_queue, num_workers), *workers)
 
-                    time.sleep(1)
-                    break
+        self.save_snapshot()
+        await asyncio.to_thread(self.flush_writes)
+        self.logger.info("Translation completed")
+        return self.translated
 
-                except Exception as e:
-                    retry_count += 1
-                    self.logger.error(f"Error processing chunk (attempt {retry_count}/{max_retries}): {e}")
-                    self.adjust_chunk_size(False)
+    async def translate_all_batched(self, texts: Dict[str, str], target_length: int = 2000, poll_interval: float = 20):
+        """Message Batches API로 전체 청크를 한 번에 제출 (비용 50%, 결과는 최대 24시간 내 반환)
+
+        모든 청크를 제출 시점의 glossary로 미리 만들기 때문에, 실행 중 추가되는 new_terms는
+        같은 배치의 다른 청크에 반영되지 않는다.
+        """
+        chunks = [self.prepare_request(chunk) for chunk in self._iter_chunks(self.deduplicate_sources(texts), target_length)]
+        if not chunks:
+            self.logger.info("Nothing to translate")
+            return self.translated
+
+        requests = []
+        original_chunks = {}
+        for i, (request_data, original_chunk) in enumerate(chunks):
+            custom_id = f"chunk_{i}"
+            original_chunks[custom_id] = original_chunk
+            requests.append(
+                Request(custom_id=custom_id, params=MessageCreateParamsNonStreaming(**self._message_params(request_data)))
+            )
+
+        batch = await self.client.messages.batches.create(requests=requests)
+        self.logger.info(f"Submitted batch {batch.id} with {len(requests)} chunks")
+
+        while batch.processing_status != "ended":
+            await asyncio.sleep(poll_interval)
+            batch = await self.client.messages.batches.retrieve(batch.id)
+            self.logger.info(f"Batch {batch.id} status: {batch.processing_status}, {batch.request_counts}")
+
+        failed_texts = {}
+        async for entry in await self.client.messages.batches.results(batch.id):
+            original_chunk = original_chunks[entry.custom_id]
+            if entry.result.type == "succeeded":
+                stored = self.process_response(entry.result.message.content, original_chunk)
+                missing = {id_: text for id_, text in original_chunk.items() if id_ not in stored}
+                if missing:
+                    self.logger.error(f"Chunk {entry.custom_id}: {len(missing)} texts missing from response")
+                    failed_texts.update(missing)
+            else:
+                self.logger.error(f"Chunk {entry.custom_id} {entry.result.type}")
+                failed_texts.update(original_chunk)
 
-                    if retry_count == max_retries:
-                        self.logger.error(f"Failed to process chunk after {max_retries} attempts")
-                        # 실패한 청크의 텍스트들을 기록
-                        self.save_json(original_chunk, "failed_translations.json")
-                    else:
-                        time.sleep(retry_count * 2)
+        if failed_texts:
+            # 실패한 청크의 텍스트들을 기록
+            self.record_failed(failed_texts)
 
-        self.logger.info("Translation completed")
+        self.save_snapshot()
+        await asyncio.to_thread(self.flush_writes)
+        self.logger.info(f"Batch translation completed: {len(self.translated)}/{len(texts)} translated")
         return self.translated
 
 
@@ -247,7 +676,6 @@ if __name__ == "__main__":
 
     configfile = toml.load("localconfig.toml")
     api_key = configfile["local"]["CLAUDE_API_KEY"]
-    data = read_csv("1230.csv")
     translator = GameTranslator(api_key)
 
     need_trans_name_start = (
@@ -256,9 +684,10 @@ if __name__ == "__main__":
         "TimeEcho",
         "TimeTalent",
     )
-    texts_to_translate = {row["Name"]: row["CHT"] for row in data}
+    texts_to_translate = read_csv_columns("1230.csv", "Name", "CHT")
     # texts_to_translate = {
     #     k: v for k, v in texts_to_translate.items() if any(k.startswith(y) for y in need_trans_name_start)
     # }
     # pprint(texts_to_translate)
-    translated_texts = translator.translate_all(texts_to_translate)
+    translated_texts = asyncio.run(translator.translate_all(texts_to_translate))
+    # translated_texts = asyncio.run(translator.translate_all_batched(texts_to_translate))
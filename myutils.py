@@ -1,4 +1,6 @@
 import csv
+import pyarrow as pa
+import pyarrow.csv as pac
 
 def read_csv(file:str)->list[dict]:
     """
@@ -7,11 +9,24 @@ def read_csv(file:str)->list[dict]:
     CHT: Original traditional Chinese 
     KOR: Translated Korean
     """
-    with open(file, encoding="utf-8") as f:
-        first_8_letter = f.read(8)
-        if first_8_letter.startswith('\ufeff'):
-            f.seek(3)
-        else:
-            f.seek(0)
+    # utf-8-sig strips a leading BOM if present; newline="" is what the csv module expects
+    with open(file, encoding="utf-8-sig", newline="") as f:
         reader = csv.DictReader(f)
-        return list(reader)
\ No newline at end of file
+        return list(reader)
+
+def read_csv_columns(file:str, key_column:str="Name", value_column:str="CHT")->dict[str, str]:
+    """
+    Read only two columns with pyarrow's C parser and return them as {key: value},
+    without building a dict per row. A leading BOM is stripped by utf-8-sig.
+    """
+    table = pac.read_csv(
+        file,
+        read_options=pac.ReadOptions(encoding="utf-8-sig"),
+        # quoted values may contain newlines; without this, blocks can split inside a value
+        parse_options=pac.ParseOptions(newlines_in_values=True),
+        convert_options=pac.ConvertOptions(
+            include_columns=[key_column, value_column],
+            column_types={key_column: pa.string(), value_column: pa.string()},
+        ),
+    )
+    return dict(zip(table[key_column].to_pylist(), table[value_column].to_pylist()))